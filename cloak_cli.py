@@ -7,6 +7,8 @@ import click
 import os
 from pathlib import Path
 import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Optional
 
 from src.fawkes_wrapper import FawkesWrapper
@@ -29,8 +31,12 @@ def cli():
 @click.option('--skip-fawkes', is_flag=True, help='Skip Fawkes processing')
 @click.option('--skip-advcloak', is_flag=True, help='Skip AdvCloak processing')
 @click.option('--compare', is_flag=True, help='Generate comparison report')
+@click.option('--compile', 'compile_loss', is_flag=True,
+              help='torch.compile the AdvCloak loss on CUDA (only worth it for long runs)')
+@click.option('--lanczos', is_flag=True,
+              help='Resample mismatched image sizes with LANCZOS instead of bilinear')
 def cloak(input_image, output_dir, fawkes_level, advcloak_epsilon, advcloak_iter, 
-          skip_fawkes, skip_advcloak, compare):
+          skip_fawkes, skip_advcloak, compare, compile_loss, lanczos):
     """Cloak an image using Fawkes and/or AdvCloak"""
     
     input_path = Path(input_image)
@@ -54,10 +60,14 @@ def cloak(input_image, output_dir, fawkes_level, advcloak_epsilon, advcloak_iter
     # Run Fawkes
     if not skip_fawkes:
         click.echo("\n🎭 Running Fawkes facial cloaking...")
-        fawkes = FawkesWrapper()
+        # Keep TensorFlow out of this process when AdvCloak's torch needs the GPU next
+        fawkes = FawkesWrapper(in_process=skip_advcloak)
         
         with click.progressbar(length=100, label='Fawkes processing') as bar:
-            success = fawkes.cloak_image(str(input_path), str(fawkes_output), fawkes_level)
+            try:
+                success = fawkes.cloak_image(str(input_path), str(fawkes_output), fawkes_level)
+            finally:
+                fawkes.close()
             bar.update(100)
             
         if success:
@@ -69,7 +79,7 @@ def cloak(input_image, output_dir, fawkes_level, advcloak_epsilon, advcloak_iter
     # Run AdvCloak  
     if not skip_advcloak:
         click.echo("\n🛡️  Running AdvCloak adversarial cloaking...")
-        advcloak = AdvCloakWrapper()
+        advcloak = AdvCloakWrapper(compile_loss=compile_loss)
         
         with click.progressbar(length=100, label='AdvCloak processing') as bar:
             success = advcloak.cloak_image(str(input_path), str(advcloak_output), 
@@ -85,7 +95,7 @@ def cloak(input_image, output_dir, fawkes_level, advcloak_epsilon, advcloak_iter
     # Generate comparison
     if compare and (results['fawkes']['success'] or results['advcloak']['success']):
         click.echo("\n📊 Generating comparison report...")
-        comparator = CloakingComparator()
+        comparator = CloakingComparator(lanczos_resize=lanczos)
         
         report_path = output_path / f"{input_path.stem}_comparison.png"
         metrics = comparator.generate_comparison_report(
@@ -113,14 +123,16 @@ def cloak(input_image, output_dir, fawkes_level, advcloak_epsilon, advcloak_iter
 @cli.command()
 @click.argument('original', type=click.Path(exists=True))
 @click.argument('cloaked', type=click.Path(exists=True))
-def compare(original, cloaked):
+@click.option('--lanczos', is_flag=True,
+              help='Resample mismatched image sizes with LANCZOS instead of bilinear')
+def compare(original, cloaked, lanczos):
     """Compare original and cloaked images"""
     
     click.echo(f"Comparing images...")
     click.echo(f"Original: {original}")  
     click.echo(f"Cloaked: {cloaked}")
     
-    comparator = CloakingComparator()
+    comparator = CloakingComparator(lanczos_resize=lanczos)
     metrics = comparator.compare_images(original, cloaked)
     
     click.echo("\nComparison Metrics:")
@@ -150,7 +162,10 @@ def setup():
 @click.argument('input_dir', type=click.Path(exists=True))
 @click.option('--output-dir', '-o', default='batch_output', help='Output directory')
 @click.option('--method', type=click.Choice(['fawkes', 'advcloak', 'both']), default='both')
-def batch(input_dir, output_dir, method):
+@click.option('--workers', '-j', default=1, type=int,
+              help='Fawkes worker processes. Extra workers run Fawkes on the CPU while '
+                   'AdvCloak runs in this process')
+def batch(input_dir, output_dir, method, workers):
     """Process multiple images in batch"""
     
     input_path = Path(input_dir)
@@ -168,23 +183,113 @@ def batch(input_dir, output_dir, method):
     
     click.echo(f"Found {len(image_files)} images to process")
     
-    with click.progressbar(image_files, label='Processing images') as bar:
-        for img_file in bar:
-            try:
-                # Use the cloak command for each file
-                from click.testing import CliRunner
-                runner = CliRunner()
-                
-                args = [str(img_file), '--output-dir', str(output_path)]
-                if method == 'fawkes':
-                    args.append('--skip-advcloak')
-                elif method == 'advcloak':
-                    args.append('--skip-fawkes')
-                
-                runner.invoke(cloak, args)
-                
-            except Exception as e:
-                click.echo(f"Error processing {img_file}: {e}")
+    fawkes = None
+    if method in ('fawkes', 'both'):
+        # Set up Fawkes once here so workers never clone or pip install concurrently. When
+        # AdvCloak runs in this process too, Fawkes runs in a worker so TensorFlow never
+        # holds VRAM that torch needs
+        fawkes = FawkesWrapper(in_process=method == 'fawkes')
+        if not fawkes.setup_fawkes():
+            click.echo("❌ Fawkes setup failed, skipping Fawkes")
+            fawkes = None
+    # A single AdvCloak ensemble, loaded once and shared across all images
+    advcloak = AdvCloakWrapper() if method in ('advcloak', 'both') else None
+    
+    workers = max(1, min(workers, len(image_files)))
+    if fawkes is None or workers == 1:
+        try:
+            with click.progressbar(image_files, label='Processing images') as bar:
+                for img_file in bar:
+                    try:
+                        _cloak_file(img_file, output_path, fawkes, advcloak)
+                    except Exception as e:
+                        click.echo(f"Error processing {img_file}: {e}")
+        finally:
+            if fawkes is not None:
+                fawkes.close()
+        return
+    
+    # Fawkes runs on CPU-only worker processes while AdvCloak keeps the GPU in this
+    # process. Spawn (not fork) so workers never inherit this process's CUDA state
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                             initializer=_init_fawkes_worker) as executor:
+        futures = {executor.submit(_fawkes_one, img_file, output_path): img_file
+                   for img_file in image_files}
+        
+        advcloak_results = {}
+        if advcloak is not None:
+            with click.progressbar(image_files, label='AdvCloak processing') as bar:
+                for img_file in bar:
+                    try:
+                        advcloak_results[img_file] = _run_advcloak(img_file, output_path, advcloak)
+                    except Exception as e:
+                        click.echo(f"Error processing {img_file}: {e}")
+        
+        with click.progressbar(length=len(futures), label='Fawkes processing') as bar:
+            for future in as_completed(futures):
+                img_file = futures[future]
+                try:
+                    fawkes_result = future.result()
+                except Exception as e:
+                    click.echo(f"Error processing {img_file}: {e}")
+                    fawkes_result = {'success': False, 'output': None}
+                _save_results(img_file, output_path, fawkes_result,
+                              advcloak_results.get(img_file, {'success': False, 'output': None}))
+                bar.update(1)
+
+# Fawkes wrapper owned by the current batch worker process, set up by _init_fawkes_worker
+_batch_state = {}
+
+def _init_fawkes_worker() -> None:
+    """Create this worker's Fawkes wrapper once so its models load once per worker, not per image"""
+    # Keep Fawkes off the GPU, which belongs to AdvCloak in the parent process
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    _batch_state['fawkes'] = FawkesWrapper()
+
+def _fawkes_one(input_path: Path, output_path: Path) -> dict:
+    """Cloak one image with the current batch worker's Fawkes wrapper"""
+    return _run_fawkes(input_path, output_path, _batch_state['fawkes'])
+
+def _run_fawkes(input_path: Path, output_path: Path, fawkes: FawkesWrapper,
+                fawkes_level: str = 'mid') -> dict:
+    """Cloak a single image with Fawkes and return its result entry"""
+    fawkes_output = output_path / f"{input_path.stem}_fawkes.png"
+    if fawkes.cloak_image(str(input_path), str(fawkes_output), fawkes_level):
+        return {'success': True, 'output': str(fawkes_output)}
+    return {'success': False, 'output': None}
+
+def _run_advcloak(input_path: Path, output_path: Path, advcloak: AdvCloakWrapper,
+                  advcloak_epsilon: float = 0.03, advcloak_iter: int = 20) -> dict:
+    """Cloak a single image with AdvCloak and return its result entry"""
+    advcloak_output = output_path / f"{input_path.stem}_advcloak.png"
+    if advcloak.cloak_image(str(input_path), str(advcloak_output), advcloak_epsilon, advcloak_iter):
+        return {'success': True, 'output': str(advcloak_output)}
+    return {'success': False, 'output': None}
+
+def _save_results(input_path: Path, output_path: Path, fawkes_result: dict,
+                  advcloak_result: dict) -> dict:
+    """Write the results JSON for one image"""
+    results = {
+        'input': str(input_path),
+        'fawkes': fawkes_result,
+        'advcloak': advcloak_result
+    }
+    
+    results_path = output_path / f"{input_path.stem}_results.json"
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    
+    return results
+
+def _cloak_file(input_path: Path, output_path: Path,
+                fawkes: Optional[FawkesWrapper], advcloak: Optional[AdvCloakWrapper]) -> dict:
+    """Cloak a single image with the given wrappers and save its results JSON"""
+    not_run = {'success': False, 'output': None}
+    fawkes_result = _run_fawkes(input_path, output_path, fawkes) if fawkes is not None else not_run
+    advcloak_result = (_run_advcloak(input_path, output_path, advcloak)
+                       if advcloak is not None else not_run)
+    return _save_results(input_path, output_path, fawkes_result, advcloak_result)
 
 @cli.command()
 @click.argument('input_image', type=click.Path(exists=True))
@@ -192,7 +297,9 @@ def batch(input_dir, output_dir, method):
 @click.option('--strength', type=click.Choice(['medium', 'strong', 'maximum']), default='strong',
               help='Protection strength against LLMs')
 @click.option('--compare', is_flag=True, help='Generate comparison report')
-def llm_proof(input_image, output_dir, strength, compare):
+@click.option('--compile', 'compile_loss', is_flag=True,
+              help='torch.compile the AdvCloak loss on CUDA (only worth it for long runs)')
+def llm_proof(input_image, output_dir, strength, compare, compile_loss):
     """
     Specialized mode for protecting against LLM vision models (ChatGPT, Claude, etc.)
     
@@ -229,7 +336,7 @@ def llm_proof(input_image, output_dir, strength, compare):
     
     # Run enhanced AdvCloak
     click.echo("\n🛡️  Running LLM-targeted adversarial cloaking...")
-    advcloak = AdvCloakWrapper()
+    advcloak = AdvCloakWrapper(ensemble_size="full", compile_loss=compile_loss)
     
     with click.progressbar(length=100, label=f'LLM protection ({strength})') as bar:
         success = advcloak.cloak_image(str(input_path), str(advcloak_output), 
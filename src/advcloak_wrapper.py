@@ -3,15 +3,36 @@ AdvCloak wrapper for broader AI model adversarial cloaking
 """
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.transforms as transforms
+from torchvision.io import read_image, ImageReadMode
 from PIL import Image
 import numpy as np
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 import cv2
 
 class AdvCloakWrapper:
-    def __init__(self, device: str = "auto"):
+    # Full torchvision ensemble; CLIP ViT-B/32 is added on top when installed
+    FULL_ENSEMBLE = ('resnet50', 'efficientnet_b0', 'vit_b_16', 'vit_l_16', 'swin_t')
+    # Free VRAM needed before "auto" keeps ViT-L/16 in the ensemble
+    VIT_L_MIN_FREE_BYTES = 12 * 1024 ** 3
+    
+    def __init__(self, device: str = "auto", ensemble_size: str = "auto",
+                 compile_loss: bool = False):
+        """
+        Args:
+            device: "auto" picks CUDA when available, otherwise any torch device string
+            ensemble_size: "full" loads every model; "auto" uses only ResNet50 on CPU and
+                drops ViT-L/16 on GPUs with less than 12 GB free
+            compile_loss: torch.compile the PGD loss on CUDA. Compiling the ensemble takes
+                far longer than a short attack and is repeated for every new image size,
+                so it only pays off for long runs on same-sized images
+        """
+        if ensemble_size not in ("auto", "full"):
+            raise ValueError(f"ensemble_size must be 'auto' or 'full', got {ensemble_size!r}")
         self.device = self._get_device(device)
+        self.ensemble_size = ensemble_size
+        self.compile_loss = compile_loss
         self.transform = transforms.Compose([
             transforms.Resize((224, 224)),
             transforms.ToTensor(),
@@ -23,124 +44,180 @@ class AdvCloakWrapper:
                                std=[1/0.229, 1/0.224, 1/0.225]),
             transforms.ToPILImage()
         ])
+        # ImageNet normalization constants, shaped for broadcasting over NCHW batches
+        self._mean = torch.tensor([0.485, 0.456, 0.406], device=self.device).view(1, 3, 1, 1)
+        self._inv_std = (1.0 / torch.tensor([0.229, 0.224, 0.225], device=self.device)).view(1, 3, 1, 1)
+        self._compiled_pgd_loss = None
+        # BF16 autocast for ensemble forwards on GPUs with native bfloat16 support (Ampere and
+        # newer); is_bf16_supported() also reports emulated support, which is slower than FP32
+        self._use_autocast = (self.device.type == "cuda"
+                              and torch.cuda.get_device_capability(self.device)[0] >= 8)
+        self._models = None
         
     def _get_device(self, device: str) -> torch.device:
         if device == "auto":
             return torch.device("cuda" if torch.cuda.is_available() else "cpu")
         return torch.device(device)
     
-    def generate_adversarial_noise(self, image: Image.Image, 
+    def generate_adversarial_noise(self, image: Union[Image.Image, torch.Tensor], 
                                  epsilon: float = 0.05,  # Stronger for LLMs
                                  iterations: int = 50) -> np.ndarray:  # More iterations for LLMs
         """
         Generate stronger adversarial noise specifically targeting LLM vision encoders
         
         Args:
-            image: PIL Image
+            image: PIL Image or uint8 CHW tensor (as returned by torchvision.io.read_image)
             epsilon: Perturbation magnitude (higher values for LLM protection)
             iterations: Number of optimization steps (more for stronger attacks)
         """
+        _, delta = self._optimize_perturbation(image, epsilon, iterations)
+        
+        # Return final perturbation
+        final_perturbation = delta.detach().cpu().numpy().squeeze().transpose(1, 2, 0)
+        return final_perturbation
+    
+    def _optimize_perturbation(self, image: Union[Image.Image, torch.Tensor],
+                               epsilon: float, iterations: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Run the ensemble PGD attack and return the on-device (image, perturbation) pair"""
         # Convert to tensor and normalize
-        img_array = np.array(image) / 255.0  # Normalize to 0-1
-        img_tensor = torch.FloatTensor(img_array).permute(2, 0, 1).unsqueeze(0).to(self.device)
+        if isinstance(image, Image.Image):
+            image = torch.from_numpy(np.array(image)).permute(2, 0, 1)
+        # Move uint8 to device first, then scale to 0-1
+        img_tensor = image.to(self.device).float().div_(255.0).unsqueeze(0)
+        # NHWC layout lets cuDNN pick its faster conv kernels
+        img_tensor = img_tensor.contiguous(memory_format=torch.channels_last)
         
         # Get ensemble of models for stronger attack
         models = self._get_ensemble_models()
         
-        # Create model input preparation function
-        def prepare_for_model(x):
-            """Prepare image tensor for model input"""
-            # Resize to model input size
-            resized = torch.nn.functional.interpolate(x, size=(224, 224), mode='bilinear', align_corners=False)
-            # Apply ImageNet normalization
-            normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-            return normalize(resized.squeeze(0)).unsqueeze(0)
-        
         # Get original predictions for ensemble attack
-        original_preds = []
+        original_probs = []
         original_features = []
-        with torch.no_grad():
-            original_input = prepare_for_model(img_tensor)
-            for model in models:
-                try:
-                    if hasattr(model, 'encode_image'):  # CLIP model
-                        features = model.encode_image(original_input)
-                        original_features.append(features)
-                    else:
-                        pred = model(original_input)
-                        if pred.dim() > 1:
-                            pred = pred.argmax(1)
-                        original_preds.append(pred)
-                except Exception as e:
-                    print(f"Warning: Model prediction failed: {e}")
-                    continue
+        with torch.inference_mode():
+            original_input = self._prepare_for_model(img_tensor)
+            with self._autocast():
+                for model in models['classifier']:
+                    # Keep the full distribution as a soft target (no argmax/host sync)
+                    original_probs.append(F.softmax(model(original_input).float(), dim=1))
+                for model in models['clip']:
+                    original_features.append(model(original_input).float())
+        # Inference tensors cannot be saved for backward, so hand the PGD loss normal copies
+        original_input = original_input.clone()
+        original_probs = [probs.clone() for probs in original_probs]
+        original_features = [features.clone() for features in original_features]
         
-        # Initialize perturbation
-        delta = torch.zeros_like(img_tensor, requires_grad=True, device=self.device)
+        # Initialize perturbation with a random start inside the epsilon ball: at delta = 0
+        # the KL and CLIP terms have zero gradient
+        delta = torch.empty_like(img_tensor, memory_format=torch.channels_last).uniform_(-epsilon, epsilon)
+        delta.add_(img_tensor).clamp_(0, 1).sub_(img_tensor)
+        delta.requires_grad_(True)
         alpha = epsilon / iterations
+        loss_args = (original_input, models, original_probs, original_features)
+        # Settle compiled vs eager once, outside the loop, along with the first step's loss
+        pgd_loss, total_loss = self._resolve_pgd_loss(delta, loss_args)
+        # Scratch buffer for the gradient sign, reused every iteration
+        grad_sign = torch.empty_like(delta, requires_grad=False)
         
         # Enhanced PGD iterations with ensemble attack targeting LLMs
         for i in range(iterations):
-            # Apply current perturbation
-            perturbed = img_tensor + delta
-            perturbed = torch.clamp(perturbed, 0, 1)
+            if i > 0:
+                total_loss = pgd_loss(delta, *loss_args)
             
-            # Prepare for model
-            model_input = prepare_for_model(perturbed)
-            
-            # Enhanced ensemble attack - compute loss across all models
-            total_loss = 0
-            loss_count = 0
-            
-            for j, model in enumerate(models):
-                try:
-                    if hasattr(model, 'encode_image'):  # CLIP model
-                        # For CLIP, maximize feature distance
-                        perturbed_features = model.encode_image(model_input)
-                        if j < len(original_features):
-                            # Cosine similarity loss - minimize similarity
-                            cos_sim = torch.nn.functional.cosine_similarity(
-                                perturbed_features, original_features[j], dim=-1
-                            )
-                            feature_loss = cos_sim.mean()  # Minimize similarity
-                            total_loss += feature_loss
-                            loss_count += 1
-                    else:
-                        # For classification models
-                        outputs = model(model_input)
-                        if j < len(original_preds):
-                            # Use multiple loss types for stronger attack
-                            ce_loss = nn.CrossEntropyLoss()(outputs, original_preds[j])
-                            # Add confidence reduction loss
-                            conf_loss = torch.mean(torch.max(torch.softmax(outputs, dim=1), dim=1)[0])
-                            total_loss += ce_loss + 0.5 * conf_loss
-                            loss_count += 1
-                except Exception as e:
-                    continue
-            
-            if loss_count == 0:
+            if total_loss is None:
                 print(f"Warning: No valid models for iteration {i}")
                 break
                 
-            # Backward pass
-            total_loss.backward(retain_graph=True)
+            # Backward pass (graph is rebuilt every iteration, no need to retain it)
+            total_loss.backward()
             
             # Update perturbation
             with torch.no_grad():
                 if delta.grad is not None:
                     # Apply gradient ascent to maximize loss (reduce confidence/similarity)
-                    grad_sign = delta.grad.sign()
-                    delta.data = delta.data + alpha * grad_sign
+                    torch.sign(delta.grad, out=grad_sign)
+                    delta.add_(grad_sign, alpha=alpha)
                     
                     # Project perturbation to l_infinity ball
-                    delta.data = torch.clamp(delta.data, -epsilon, epsilon)
+                    delta.clamp_(-epsilon, epsilon)
+                    
+                    # Keep image + delta inside [0, 1] so the loss can skip the clamp
+                    delta.add_(img_tensor).clamp_(0, 1).sub_(img_tensor)
                     
                     # Clear gradients for next iteration
                     delta.grad.zero_()
         
-        # Return final perturbation
-        final_perturbation = delta.detach().cpu().numpy().squeeze().transpose(1, 2, 0)
-        return final_perturbation
+        return img_tensor, delta.detach()
+    
+    def _resize_for_model(self, x: torch.Tensor) -> torch.Tensor:
+        """Resize to model input size (skipped when the image is already 224x224)"""
+        if x.shape[-2:] == (224, 224):
+            return x
+        return F.interpolate(x, size=(224, 224), mode='bilinear', align_corners=False)
+    
+    def _prepare_for_model(self, x: torch.Tensor) -> torch.Tensor:
+        """Prepare image tensor for model input"""
+        # Apply ImageNet normalization on the 4D tensor to keep channels_last layout
+        return (self._resize_for_model(x) - self._mean) * self._inv_std
+    
+    def _pgd_loss(self, delta, base_input, models, original_probs, original_features):
+        """Forward half of one PGD step: ensemble loss for the current perturbation"""
+        # Bilinear resize and normalization are linear, so the model input for image + delta
+        # is the precomputed base input plus the resized, scaled delta
+        model_input = base_input + self._resize_for_model(delta) * self._inv_std
+        
+        # Enhanced ensemble attack - collect per-model losses and sum them once
+        losses = []
+        
+        with self._autocast():
+            classifier_outputs = [model(model_input) for model in models['classifier']]
+            clip_features = [model(model_input) for model in models['clip']]
+        
+        # For classification models
+        for outputs, original in zip(classifier_outputs, original_probs):
+            log_probs = F.log_softmax(outputs.float(), dim=1)
+            # Use multiple loss types for stronger attack: push the prediction away
+            # from the original distribution (maximize KL)
+            kl_loss = F.kl_div(log_probs, original, reduction='batchmean')
+            # Add confidence reduction loss, negated so gradient ascent lowers top-class confidence
+            conf_loss = log_probs.max(dim=1).values.exp().mean()
+            losses.append(kl_loss - 0.5 * conf_loss)
+        
+        # For CLIP, maximize feature distance
+        for features, original in zip(clip_features, original_features):
+            # Cosine similarity loss (reduced in FP32), negated so gradient ascent lowers similarity
+            cos_sim = F.cosine_similarity(features.float(), original, dim=-1)
+            losses.append(-cos_sim.mean())
+        
+        if not losses:
+            return None
+        return torch.stack(losses).sum()
+    
+    def _autocast(self):
+        """Autocast context for ensemble forward passes (no-op unless BF16 is available)"""
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16,
+                              enabled=self._use_autocast)
+    
+    def _resolve_pgd_loss(self, delta, loss_args):
+        """Return the PGD loss step to use for this attack and the loss of its first call"""
+        pgd_loss = self._get_pgd_loss_fn()
+        if pgd_loss == self._pgd_loss:
+            return pgd_loss, pgd_loss(delta, *loss_args)
+        try:
+            return pgd_loss, pgd_loss(delta, *loss_args)
+        except Exception as e:
+            # Compilation problems surface on the first call, fall back to eager mode
+            print(f"Warning: torch.compile failed, using eager mode: {e}")
+            self._compiled_pgd_loss = self._pgd_loss
+            return self._pgd_loss, self._pgd_loss(delta, *loss_args)
+    
+    def _get_pgd_loss_fn(self):
+        """Return the PGD loss step, compiled with torch.compile on CUDA when requested"""
+        if self._compiled_pgd_loss is None:
+            self._compiled_pgd_loss = self._pgd_loss
+            if self.compile_loss and self.device.type == 'cuda' and hasattr(torch, 'compile'):
+                # reduce-overhead fuses the elementwise ops and replays CUDA graphs per iteration
+                self._compiled_pgd_loss = torch.compile(self._pgd_loss, mode='reduce-overhead', fullgraph=False)
+        return self._compiled_pgd_loss
     
     def cloak_image(self, input_path: str, output_path: str,
                    epsilon: float = 0.03, iterations: int = 20) -> bool:
@@ -155,17 +232,19 @@ class AdvCloakWrapper:
         """
         try:
             # Load image
-            image = Image.open(input_path).convert('RGB')
+            image = self._load_image(input_path)
             
             # Generate subtle adversarial noise
-            noise = self.generate_adversarial_noise(image, epsilon, iterations)
+            img_tensor, delta = self._optimize_perturbation(image, epsilon, iterations)
             
-            # Apply noise to original image (no resizing!)
-            img_array = np.array(image) / 255.0
-            cloaked_array = np.clip(img_array + noise, 0, 1)
+            # Apply noise to original image on device (no resizing!) and only
+            # transfer the quantized uint8 result back to the host
+            cloaked = (img_tensor + delta).clamp_(0, 1)
+            cloaked_u8 = (cloaked.mul_(255).round_().clamp_(0, 255).to(torch.uint8)
+                          .squeeze(0).permute(1, 2, 0).contiguous().cpu().numpy())
             
             # Convert back to PIL (preserving original dimensions)
-            cloaked_image = Image.fromarray((cloaked_array * 255).astype(np.uint8))
+            cloaked_image = Image.fromarray(cloaked_u8)
             
             # Save
             cloaked_image.save(output_path)
@@ -175,9 +254,43 @@ class AdvCloakWrapper:
             print(f"Error in AdvCloak processing: {e}")
             return False
     
-    def _get_ensemble_models(self):
-        """Get ensemble of models for stronger adversarial generation targeting LLMs"""
-        models = []
+    def _load_image(self, input_path: str) -> torch.Tensor:
+        """Decode an image to a uint8 CHW RGB tensor"""
+        try:
+            # libjpeg-turbo/libpng decode straight into a tensor
+            return read_image(input_path, mode=ImageReadMode.RGB)
+        except (RuntimeError, ValueError):
+            # torchvision.io does not handle every format (e.g. BMP, TIFF)
+            image = Image.open(input_path).convert('RGB')
+            return torch.from_numpy(np.array(image)).permute(2, 0, 1)
+    
+    def _get_ensemble_models(self) -> Dict[str, List[nn.Module]]:
+        """Get ensemble of models, loading them on first use and reusing them afterwards"""
+        if self._models is None:
+            self._models = self._load_ensemble()
+        return self._models
+    
+    def _select_ensemble(self) -> Tuple[Tuple[str, ...], bool]:
+        """Pick the torchvision models to load, and whether to add CLIP, for this device"""
+        if self.ensemble_size == "full":
+            return self.FULL_ENSEMBLE, True
+        
+        # Every extra model costs seconds per iteration on CPU
+        if self.device.type == "cpu":
+            return ('resnet50',), False
+        
+        model_names = self.FULL_ENSEMBLE
+        if self.device.type == "cuda":
+            free_bytes, _ = torch.cuda.mem_get_info(self.device)
+            if free_bytes < self.VIT_L_MIN_FREE_BYTES:
+                print(f"Only {free_bytes / 1e9:.1f}GB VRAM free, skipping vit_l_16")
+                model_names = tuple(name for name in model_names if name != 'vit_l_16')
+        return model_names, True
+    
+    def _load_ensemble(self) -> Dict[str, List[nn.Module]]:
+        """Load ensemble of models for stronger adversarial generation targeting LLMs"""
+        models = {'classifier': [], 'clip': []}
+        model_names, use_clip = self._select_ensemble()
         
         try:
             import torchvision.models as torchmodels
@@ -190,19 +303,27 @@ class AdvCloakWrapper:
                 ('vit_l_16', torchmodels.vit_l_16, 'IMAGENET1K_V1'),  # Larger ViT for LLMs
                 ('swin_t', torchmodels.swin_t, 'IMAGENET1K_V1'),      # Swin Transformer
             ]
+            model_configs = [config for config in model_configs if config[0] in model_names]
             
             # Try to load CLIP if available for direct LLM targeting
-            try:
-                import clip
-                print("Loading CLIP model for direct LLM vision targeting...")
-                clip_model, clip_preprocess = clip.load("ViT-B/32", device=self.device)
-                clip_model.eval()
-                for param in clip_model.parameters():
-                    param.requires_grad = False
-                models.append(clip_model.visual)  # Use visual encoder
-                print("✅ CLIP ViT-B/32 loaded for LLM targeting")
-            except ImportError:
-                print("⚠️  CLIP not available, using ViT proxies")
+            if use_clip:
+                try:
+                    import clip
+                    print("Loading CLIP model for direct LLM vision targeting...")
+                    clip_model, clip_preprocess = clip.load("ViT-B/32", device=self.device)
+                    clip_model.eval()
+                    if not self._use_autocast:
+                        # clip.load returns FP16 weights on CUDA, which need autocast for FP32 input
+                        clip_model.float()
+                    for param in clip_model.parameters():
+                        param.requires_grad = False
+                    models['clip'].append(clip_model.visual)  # Use visual encoder
+                    print("✅ CLIP ViT-B/32 loaded for LLM targeting")
+                except ImportError:
+                    print("⚠️  CLIP not available, using ViT proxies")
+                except Exception as e:
+                    # e.g. CUDA OOM, which must not abort loading the torchvision models
+                    print(f"❌ Failed to load CLIP: {e}")
             
             for name, model_fn, weights in model_configs:
                 try:
@@ -210,12 +331,13 @@ class AdvCloakWrapper:
                     model = model_fn(weights=weights)
                     model.eval()
                     model.to(self.device)
+                    model.to(memory_format=torch.channels_last)
                     
                     # Disable gradients for model parameters
                     for param in model.parameters():
                         param.requires_grad = False
                         
-                    models.append(model)
+                    models['classifier'].append(model)
                     print(f"✅ {name} loaded successfully")
                     
                 except Exception as e:
@@ -225,8 +347,11 @@ class AdvCloakWrapper:
         except Exception as e:
             print(f"Warning: Could not load torchvision models: {e}")
         
+        # Drop anything that cannot run a forward pass so the PGD loop needs no error handling
+        models = self._validate_models(models)
+        
         # If no models loaded, use fallback
-        if not models:
+        if not models['classifier'] and not models['clip']:
             print("Using fallback simple model...")
             model = nn.Sequential(
                 nn.Conv2d(3, 64, 3, padding=1),
@@ -239,7 +364,22 @@ class AdvCloakWrapper:
             for param in model.parameters():
                 param.requires_grad = False
                 
-            models.append(model)
+            models['classifier'].append(model)
             
-        print(f"Ensemble attack using {len(models)} models")
-        return models 
\ No newline at end of file
+        print(f"Ensemble attack using {len(models['classifier']) + len(models['clip'])} models")
+        return models
+    
+    def _validate_models(self, models: Dict[str, List[nn.Module]]) -> Dict[str, List[nn.Module]]:
+        """Run each model once on a dummy input and keep only those that succeed"""
+        dummy = torch.zeros(1, 3, 224, 224, device=self.device).contiguous(memory_format=torch.channels_last)
+        valid = {}
+        with torch.no_grad(), self._autocast():
+            for kind, kind_models in models.items():
+                valid[kind] = []
+                for model in kind_models:
+                    try:
+                        model(dummy)
+                        valid[kind].append(model)
+                    except Exception as e:
+                        print(f"❌ Dropping {type(model).__name__}, forward pass failed: {e}")
+        return valid 
\ No newline at end of file
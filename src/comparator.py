@@ -1,16 +1,22 @@
 """
 Image comparison and evaluation utilities
 """
+import math
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont
 import cv2
-from skimage.metrics import structural_similarity as ssim
 from typing import Dict, Tuple
-import matplotlib.pyplot as plt
 
 class CloakingComparator:
-    def __init__(self):
-        pass
+    # Height in pixels of each image panel in the comparison report
+    REPORT_PANEL_HEIGHT = 700
+    
+    def __init__(self, lanczos_resize: bool = False):
+        """
+        Args:
+            lanczos_resize: Resample mismatched cloaked images with LANCZOS instead of bilinear
+        """
+        self.resize_interpolation = cv2.INTER_LANCZOS4 if lanczos_resize else cv2.INTER_LINEAR
     
     def compare_images(self, original_path: str, cloaked_path: str) -> Dict[str, float]:
         """
@@ -19,27 +25,31 @@ class CloakingComparator:
         Returns:
             Dictionary with comparison metrics
         """
-        # Load images
-        original = Image.open(original_path).convert('RGB')
-        cloaked = Image.open(cloaked_path).convert('RGB')
+        # Load images as RGB arrays
+        orig_array = self._load_rgb(original_path)
+        cloak_array = self._load_rgb(cloaked_path)
         
-        # Ensure same size
-        cloaked = cloaked.resize(original.size, Image.LANCZOS)
-        
-        # Convert to arrays
-        orig_array = np.array(original)
-        cloak_array = np.array(cloaked)
+        # Ensure same size (cloakers normally preserve dimensions, so this is rarely needed)
+        height, width = orig_array.shape[:2]
+        if cloak_array.shape[:2] != (height, width):
+            print(f"Warning: cloaked image is {cloak_array.shape[1]}x{cloak_array.shape[0]}, "
+                  f"resampling to {width}x{height}; metrics include resampling artifacts")
+            cloak_array = cv2.resize(cloak_array, (width, height), interpolation=self.resize_interpolation)
         
         metrics = {}
         
+        # Signed difference (uint8 subtraction would wrap around), reused by MSE and PSNR
+        diff = orig_array.astype(np.int16) - cloak_array.astype(np.int16)
+        mse = float(np.mean(np.square(diff, dtype=np.float32)))
+        
         # Peak Signal-to-Noise Ratio (higher = more similar)
-        metrics['psnr'] = self._calculate_psnr(orig_array, cloak_array)
+        metrics['psnr'] = self._calculate_psnr(mse)
         
         # Structural Similarity Index (higher = more similar)
-        metrics['ssim'] = ssim(orig_array, cloak_array, multichannel=True, channel_axis=-1, data_range=255)
+        metrics['ssim'] = self._calculate_ssim(orig_array, cloak_array)
         
         # Mean Squared Error (lower = more similar)
-        metrics['mse'] = np.mean((orig_array - cloak_array) ** 2)
+        metrics['mse'] = mse
         
         # Normalized Root Mean Square Error
         metrics['nrmse'] = np.sqrt(metrics['mse']) / (np.max(orig_array) - np.min(orig_array))
@@ -49,13 +59,44 @@ class CloakingComparator:
         
         return metrics
     
-    def _calculate_psnr(self, img1: np.ndarray, img2: np.ndarray) -> float:
-        """Calculate Peak Signal-to-Noise Ratio"""
-        mse = np.mean((img1 - img2) ** 2)
+    def _load_rgb(self, path: str) -> np.ndarray:
+        """Load an image as an RGB uint8 array"""
+        # Ignore EXIF orientation to match what PIL and the cloakers see
+        bgr = cv2.imread(path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if bgr is None:
+            # Fall back to PIL for formats OpenCV cannot decode
+            return np.array(Image.open(path).convert('RGB'))
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+    
+    def _calculate_psnr(self, mse: float) -> float:
+        """Calculate Peak Signal-to-Noise Ratio from a precomputed MSE"""
         if mse == 0:
             return float('inf')
         max_pixel = 255.0
-        return 20 * np.log10(max_pixel / np.sqrt(mse))
+        return 20 * math.log10(max_pixel) - 10 * math.log10(mse)
+    
+    def _calculate_ssim(self, img1: np.ndarray, img2: np.ndarray) -> float:
+        """Calculate Structural Similarity with an 11x11 Gaussian window (float32, all channels)"""
+        c1 = (0.01 * 255) ** 2
+        c2 = (0.03 * 255) ** 2
+        img1 = img1.astype(np.float32)
+        img2 = img2.astype(np.float32)
+        
+        def blur(x):
+            return cv2.GaussianBlur(x, (11, 11), 1.5)
+        
+        mu1 = blur(img1)
+        mu2 = blur(img2)
+        mu1_sq = mu1 * mu1
+        mu2_sq = mu2 * mu2
+        mu1_mu2 = mu1 * mu2
+        sigma1_sq = blur(img1 * img1) - mu1_sq
+        sigma2_sq = blur(img2 * img2) - mu2_sq
+        sigma12 = blur(img1 * img2) - mu1_mu2
+        
+        ssim_map = ((2 * mu1_mu2 + c1) * (2 * sigma12 + c2)) / \
+                   ((mu1_sq + mu2_sq + c1) * (sigma1_sq + sigma2_sq + c2))
+        return float(ssim_map.mean())
     
     def _perceptual_distance(self, img1: np.ndarray, img2: np.ndarray) -> float:
         """Calculate a simplified perceptual distance"""
@@ -63,9 +104,21 @@ class CloakingComparator:
         img1_lab = cv2.cvtColor(img1, cv2.COLOR_RGB2LAB)
         img2_lab = cv2.cvtColor(img2, cv2.COLOR_RGB2LAB)
         
-        # Calculate Euclidean distance in LAB space
-        diff = img1_lab.astype(float) - img2_lab.astype(float)
-        return np.mean(np.sqrt(np.sum(diff ** 2, axis=2)))
+        # Calculate Euclidean distance in LAB space (float32, squared norm fused via einsum)
+        diff = img1_lab.astype(np.float32) - img2_lab.astype(np.float32)
+        sq_sum = np.einsum('hwc,hwc->hw', diff, diff)
+        return float(np.sqrt(sq_sum, out=sq_sum).mean())
+    
+    def _report_font(self, size: int) -> ImageFont.ImageFont:
+        """Scalable font for report titles, falling back to PIL's built-in font"""
+        try:
+            return ImageFont.truetype("DejaVuSans.ttf", size)
+        except OSError:
+            try:
+                # Scalable built-in font (Pillow >= 10.1)
+                return ImageFont.load_default(size=size)
+            except TypeError:
+                return ImageFont.load_default()
     
     def generate_comparison_report(self, original_path: str, 
                                  fawkes_path: str, advcloak_path: str,
@@ -83,31 +136,35 @@ class CloakingComparator:
         if advcloak:
             metrics['advcloak'] = self.compare_images(original_path, advcloak_path)
         
-        # Create comparison plot
-        fig, axes = plt.subplots(1, 3, figsize=(15, 5))
-        
-        axes[0].imshow(original)
-        axes[0].set_title("Original")
-        axes[0].axis('off')
-        
-        if fawkes:
-            axes[1].imshow(fawkes)
-            axes[1].set_title(f"Fawkes\nPSNR: {metrics['fawkes']['psnr']:.2f}\nSSIM: {metrics['fawkes']['ssim']:.3f}")
-            axes[1].axis('off')
-        else:
-            axes[1].text(0.5, 0.5, "Fawkes\nNot Available", ha='center', va='center', transform=axes[1].transAxes)
-            axes[1].axis('off')
-        
-        if advcloak:
-            axes[2].imshow(advcloak)
-            axes[2].set_title(f"AdvCloak\nPSNR: {metrics['advcloak']['psnr']:.2f}\nSSIM: {metrics['advcloak']['ssim']:.3f}")
-            axes[2].axis('off')
-        else:
-            axes[2].text(0.5, 0.5, "AdvCloak\nNot Available", ha='center', va='center', transform=axes[2].transAxes)
-            axes[2].axis('off')
-        
-        plt.tight_layout()
-        plt.savefig(output_path, dpi=150, bbox_inches='tight')
-        plt.close()
+        # Compose the three panels side by side under a title strip, scaled to a fixed
+        # panel height so the report stays a readable size for large photos
+        width, height = original.size
+        panel_height = min(height, self.REPORT_PANEL_HEIGHT)
+        panel_size = (max(1, round(width * panel_height / height)), panel_height)
+        font_size = max(12, panel_height // 25)
+        font = self._report_font(font_size)
+        header = 4 * font_size
+        canvas = Image.new('RGB', (3 * panel_size[0], panel_height + header), 'white')
+        draw = ImageDraw.Draw(canvas)
+        
+        panels = [
+            ("Original", original, None),
+            ("Fawkes", fawkes, metrics.get('fawkes')),
+            ("AdvCloak", advcloak, metrics.get('advcloak')),
+        ]
+        for i, (name, image, panel_metrics) in enumerate(panels):
+            x = i * panel_size[0]
+            title = name
+            if image is None:
+                title += "\nNot Available"
+            else:
+                if image.size != panel_size:
+                    image = image.resize(panel_size, Image.LANCZOS)
+                canvas.paste(image.convert('RGB'), (x, header))
+                if panel_metrics:
+                    title += f"\nPSNR: {panel_metrics['psnr']:.2f}\nSSIM: {panel_metrics['ssim']:.3f}"
+            draw.multiline_text((x + font_size // 2, font_size // 4), title, fill='black', font=font)
+        
+        canvas.save(output_path)
         
         return metrics 
\ No newline at end of file
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Persistent Fawkes worker - loads the protector once and cloaks batches read from stdin
+
+Protocol: every stdin line is a JSON list of image paths. The worker answers each line
+with "DONE" or "ERROR <message>" on stdout; Fawkes' own output goes to stderr.
+"""
+import argparse
+import json
+import os
+import sys
+
+def main():
+    parser = argparse.ArgumentParser(description="Persistent Fawkes protection worker")
+    parser.add_argument('--mode', default='mid', help='Fawkes protection level')
+    parser.add_argument('--gpu', default='-1', help='GPU id, -1 for CPU')
+    parser.add_argument('--protection-args', type=json.loads, default={},
+                        help='JSON keyword arguments for Fawkes.run_protection')
+    args = parser.parse_args()
+
+    # Keep a private copy of fd 1 for protocol replies, then point fd 1 and sys.stdout at
+    # stderr so nothing Fawkes, TensorFlow or their subprocesses print can reach the pipe
+    sys.stdout.flush()
+    replies = os.fdopen(os.dup(1), 'w', buffering=1)
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    from fawkes.protection import Fawkes
+    from fawkes_wrapper import enable_tf_memory_growth
+    # Share the GPU with other processes instead of reserving nearly all of it
+    enable_tf_memory_growth()
+    protector = Fawkes("arcface_extractor_0", args.gpu, 1, mode=args.mode)
+    print("READY", file=replies, flush=True)
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            protector.run_protection(json.loads(line), **args.protection_args)
+            print("DONE", file=replies, flush=True)
+        except Exception as e:
+            message = str(e).replace('\n', ' ')
+            print(f"ERROR {message}", file=replies, flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,147 @@
 """
 Fawkes wrapper for facial recognition cloaking
 """
+import atexit
+import functools
+import importlib.util
+import json
 import os
+import queue
+import re
 import subprocess
+import sys
 import tempfile
+import threading
 from pathlib import Path
-from typing import Optional, List
+from typing import Optional, List, Tuple
 import requests
 import zipfile
 import shutil
 
+# Leading run of import lines in a module, where the TF compatibility patch is inserted
+_IMPORT_BLOCK_RE = re.compile(r"(^(?:from|import) [^\n]*\n)+", re.M)
+
+# Arguments protection.py's CLI passes to run_protection, so every execution path
+# produces the same cloak (Fawkes.run_protection's own defaults differ)
+_PROTECTION_ARGS = {"sd": 1e6, "separate_target": False, "batch_size": 1, "format": "png"}
+
+# pip errors caused by unsatisfiable requirements rather than a bad cache entry
+_PIP_RESOLUTION_ERROR_RE = re.compile(r"ResolutionImpossible|No matching distribution")
+
+# Inserted into Fawkes' utils.py by _patch_fawkes_for_tf_compatibility
+_TF_COMPAT_PATCH = '''
+# TensorFlow/Keras compatibility patch
+import tensorflow as tf
+from tensorflow import keras
+import warnings
+warnings.filterwarnings("ignore", category=UserWarning, module="pkg_resources")
+
+# Custom model loader for compatibility
+def load_model_with_compatibility(filepath):
+    """Load model with compatibility fixes for newer TensorFlow versions"""
+    try:
+        # First try normal loading
+        return keras.models.load_model(filepath)
+    except (ValueError, TypeError) as e:
+        if "groups" in str(e) and "DepthwiseConv2D" in str(e):
+            print(f"Applying compatibility fix for model: {filepath}")
+            # Load model and fix the config
+            import h5py
+            from tensorflow.keras.utils import CustomObjectScope
+            
+            # Custom DepthwiseConv2D that ignores groups parameter
+            class CompatibleDepthwiseConv2D(keras.layers.DepthwiseConv2D):
+                def __init__(self, *args, **kwargs):
+                    # Remove incompatible 'groups' parameter
+                    kwargs.pop('groups', None)
+                    super().__init__(*args, **kwargs)
+            
+            # Try loading with custom object scope
+            with CustomObjectScope({'DepthwiseConv2D': CompatibleDepthwiseConv2D}):
+                return keras.models.load_model(filepath)
+        else:
+            raise e
+
+# Monkey patch the original load_extractor function
+original_load_extractor = None
+
+'''
+
+@functools.lru_cache(maxsize=1)
+def _detect_gpu() -> bool:
+    """Probe for an NVIDIA GPU without importing a deep learning framework (cached per process)"""
+    # Ask TensorFlow only if something already paid for importing it
+    tf = sys.modules.get("tensorflow")
+    if tf is not None:
+        try:
+            return len(tf.config.list_physical_devices('GPU')) > 0
+        except Exception:
+            pass
+    
+    visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible_devices is not None and visible_devices.strip() in ("", "-1"):
+        return False
+    return shutil.which("nvidia-smi") is not None or os.path.exists("/proc/driver/nvidia/version")
+
+def enable_tf_memory_growth():
+    """Let TensorFlow allocate GPU memory on demand instead of reserving it all"""
+    import tensorflow as tf
+    for gpu_device in tf.config.list_physical_devices('GPU'):
+        try:
+            tf.config.experimental.set_memory_growth(gpu_device, True)
+        except RuntimeError:
+            # The GPU was already initialised, its allocator can no longer change
+            pass
+
 class FawkesWrapper:
-    def __init__(self, model_dir: str = "models"):
+    # Seconds to wait for a persistent worker to load its models (may include downloads)
+    WORKER_START_TIMEOUT = 600
+    # Seconds a persistent worker may spend per image before it is considered hung
+    WORKER_IMAGE_TIMEOUT = 300
+    
+    def __init__(self, model_dir: str = "models", in_process: bool = True):
+        """
+        Args:
+            model_dir: Directory Fawkes is cloned into
+            in_process: Run Fawkes' TensorFlow models in this process. Pass False when torch
+                will use the GPU in the same process, since TensorFlow never releases VRAM
+        """
         self.model_dir = Path(model_dir)
         self.model_dir.mkdir(exist_ok=True)
         self.fawkes_dir = self.model_dir / "fawkes"
+        # In-process Fawkes protectors keyed by protection level, loaded on first use
+        self._protectors = {}
+        self._in_process_unavailable = not in_process
+        # Persistent worker processes keyed by protection level, used when in-process fails
+        self._workers = {}
+        # Reply lines read from each worker's stdout by a background thread
+        self._worker_replies = {}
+        self._worker_unavailable = False
+        # Never leave worker processes behind, even if close() is not called
+        atexit.register(self.close)
+        # Scripts launched for out-of-process runs
+        self._worker_script = str(Path(__file__).with_name("fawkes_worker.py"))
+        self._fawkes_script = str(self.fawkes_dir / "fawkes" / "protection.py")
+        # Written after a successful setup so later runs can skip the checks
+        self._ready_stamp = self.fawkes_dir / ".fawkes_ready"
+        self._setup_ok = False
         
     def setup_fawkes(self) -> bool:
         """Download and setup Fawkes if not already available"""
+        # Setup is idempotent, skip it once it succeeded in this process or a previous run
+        if self._setup_ok:
+            return True
+        if self._ready_stamp.exists():
+            self._setup_ok = True
+            return True
+        
+        if self._setup_fawkes():
+            self._ready_stamp.touch()
+            self._setup_ok = True
+        return self._setup_ok
+    
+    def _setup_fawkes(self) -> bool:
+        """Clone Fawkes and install its dependencies as needed"""
         print(f"Checking Fawkes in: {self.fawkes_dir}")
         protection_file = self.fawkes_dir / "fawkes" / "protection.py"
         print(f"Looking for protection.py at: {protection_file}")
@@ -34,9 +158,14 @@ class FawkesWrapper:
             
         print("Setting up Fawkes...")
         try:
-            # Clone Fawkes repository
-            cmd = f"git clone https://github.com/Shawn-Shan/fawkes.git {self.fawkes_dir}"
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+            # Shallow clone of the Fawkes repository (history is never needed); any
+            # submodules are fetched shallowly and in parallel
+            cmd = [
+                "git", "clone", "--depth=1", "--single-branch",
+                "--recurse-submodules", "--shallow-submodules", "--jobs=8",
+                "https://github.com/Shawn-Shan/fawkes.git", str(self.fawkes_dir)
+            ]
+            result = subprocess.run(cmd, capture_output=True, text=True)
             
             if result.returncode != 0:
                 print(f"Failed to clone Fawkes: {result.stderr}")
@@ -49,31 +178,24 @@ class FawkesWrapper:
             return False
     
     def _check_fawkes_dependencies(self) -> bool:
-        """Check if Fawkes dependencies are available"""
+        """Check if Fawkes dependencies are available (without importing TensorFlow)"""
+        missing = [name for name in ("mtcnn", "tensorflow") if not self._module_available(name)]
+        # Check both standalone keras and tf.keras
+        if not (self._module_available("keras") or self._module_available("tensorflow.keras")):
+            missing.append("keras")
+        
+        if missing:
+            print(f"❌ Missing modules: {', '.join(missing)}")
+            return False
+        return True
+    
+    @staticmethod
+    def _module_available(name: str) -> bool:
+        """Locate a module via importlib without executing it"""
         try:
-            print("Checking MTCNN...")
-            import mtcnn
-            print("✅ MTCNN OK")
-            
-            print("Checking TensorFlow...")
-            import tensorflow as tf
-            print(f"✅ TensorFlow {tf.__version__} OK")
-            
-            print("Checking Keras...")
-            # Check both standalone keras and tf.keras
-            try:
-                import keras
-                print(f"✅ Standalone Keras {keras.__version__} OK")
-            except ImportError:
-                print("No standalone Keras, checking tf.keras...")
-                if hasattr(tf, 'keras'):
-                    print("✅ tf.keras available")
-                else:
-                    raise ImportError("Neither standalone keras nor tf.keras available")
-            
-            return True
-        except ImportError as e:
-            print(f"❌ Import error: {e}")
+            return importlib.util.find_spec(name) is not None
+        except (ImportError, ValueError):
+            # find_spec imports parent packages for dotted names and can fail there
             return False
     
     def _install_fawkes_dependencies(self) -> bool:
@@ -87,24 +209,32 @@ class FawkesWrapper:
                 "numpy>=1.19.0"
             ]
             
-            for package in packages:
-                print(f"Installing {package}...")
-                cmd = f"pip install {package}"
-                result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-                if result.returncode != 0:
-                    print(f"Warning: Failed to install {package}: {result.stderr}")
-            
-            # Install Fawkes requirements if they exist
+            # Fast path: packages, Fawkes requirements and Fawkes itself in a single pip run
             req_file = self.fawkes_dir / "requirements.txt"
-            if req_file.exists():
-                print("Installing Fawkes requirements...")
-                cmd = f"pip install -r {req_file}"
-                subprocess.run(cmd, shell=True, capture_output=True, text=True)
+            requirements = ["-r", str(req_file)] if req_file.exists() else []
+            combined = [*packages, *requirements, "-e", str(self.fawkes_dir)]
             
-            # Install Fawkes as a package
-            print("Installing Fawkes package...")
-            cmd = f"pip install -e {self.fawkes_dir}"
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+            print("Installing Fawkes and its dependencies...")
+            result = self._pip_install(combined)
+            if result.returncode != 0 and not _PIP_RESOLUTION_ERROR_RE.search(result.stderr):
+                # A stale or corrupt cached wheel is a common cause, retry once bypassing the cache
+                # (pointless when the requirements simply cannot be resolved)
+                print("pip install failed, retrying without pip's cache...")
+                result = self._pip_install(combined + ["--no-cache-dir"])
+            if result.returncode != 0:
+                # Fawkes pins an old TensorFlow/Keras that may not resolve here; install each
+                # step on its own so one unsatisfiable pin does not block the rest
+                print("Combined install failed, installing dependencies step by step...")
+                result = self._pip_install(packages)
+                if result.returncode != 0:
+                    print(f"Warning: Failed to install Fawkes dependencies: {result.stderr}")
+                if requirements:
+                    print("Installing Fawkes requirements...")
+                    self._pip_install(requirements)
+                print("Installing Fawkes package...")
+                result = self._pip_install(["-e", str(self.fawkes_dir), "--no-deps"])
+                if result.returncode != 0:
+                    print(f"Warning: Failed to install Fawkes package: {result.stderr}")
             
             # Patch Fawkes for TensorFlow compatibility
             self._patch_fawkes_for_tf_compatibility()
@@ -118,8 +248,18 @@ class FawkesWrapper:
             print(f"Error installing Fawkes dependencies: {e}")
             return False
     
+    @staticmethod
+    def _pip_install(args: List[str]) -> subprocess.CompletedProcess:
+        """Run pip install with the current interpreter"""
+        cmd = [sys.executable, "-m", "pip", "install", "--disable-pip-version-check", *args]
+        return subprocess.run(cmd, capture_output=True, text=True)
+    
     def _patch_fawkes_for_tf_compatibility(self):
         """Patch Fawkes utils to handle TensorFlow version compatibility"""
+        stamp = self._patch_stamp("tf_compatibility")
+        if stamp.exists():
+            return
+        
         utils_file = self.fawkes_dir / "fawkes" / "utils.py"
         if not utils_file.exists():
             return
@@ -128,68 +268,42 @@ class FawkesWrapper:
         with open(utils_file, 'r') as f:
             content = f.read()
         
-        # Add compatibility patch at the beginning
-        patch = '''
-# TensorFlow/Keras compatibility patch
-import tensorflow as tf
-from tensorflow import keras
-import warnings
-warnings.filterwarnings("ignore", category=UserWarning, module="pkg_resources")
-
-# Custom model loader for compatibility
-def load_model_with_compatibility(filepath):
-    """Load model with compatibility fixes for newer TensorFlow versions"""
-    try:
-        # First try normal loading
-        return keras.models.load_model(filepath)
-    except (ValueError, TypeError) as e:
-        if "groups" in str(e) and "DepthwiseConv2D" in str(e):
-            print(f"Applying compatibility fix for model: {filepath}")
-            # Load model and fix the config
-            import h5py
-            from tensorflow.keras.utils import CustomObjectScope
-            
-            # Custom DepthwiseConv2D that ignores groups parameter
-            class CompatibleDepthwiseConv2D(keras.layers.DepthwiseConv2D):
-                def __init__(self, *args, **kwargs):
-                    # Remove incompatible 'groups' parameter
-                    kwargs.pop('groups', None)
-                    super().__init__(*args, **kwargs)
-            
-            # Try loading with custom object scope
-            with CustomObjectScope({'DepthwiseConv2D': CompatibleDepthwiseConv2D}):
-                return keras.models.load_model(filepath)
-        else:
-            raise e
-
-# Monkey patch the original load_extractor function
-original_load_extractor = None
-
-'''
+        # Nothing to do if already patched
+        if "load_model_with_compatibility" in content:
+            stamp.touch()
+            return
         
-        # Add the patch if not already present
-        if "load_model_with_compatibility" not in content:
-            # Find the load_extractor function and patch it
-            if "def load_extractor(" in content:
-                # Replace keras.models.load_model calls with our compatible version
-                content = content.replace(
-                    "model = keras.models.load_model(model_file)",
-                    "model = load_model_with_compatibility(model_file)"
-                )
-                
-                # Insert the patch at the top after imports
-                import_end = content.find('\n\n')
-                if import_end > 0:
-                    content = content[:import_end] + patch + content[import_end:]
-                
-                # Write back the patched content
-                with open(utils_file, 'w') as f:
-                    f.write(content)
-                
-                print("Applied TensorFlow compatibility patch to Fawkes utils.py")
+        # Only patch the load_extractor layout we know about
+        if "def load_extractor(" not in content:
+            return
+        
+        # Replace keras.models.load_model calls with our compatible version
+        content = content.replace(
+            "model = keras.models.load_model(model_file)",
+            "model = load_model_with_compatibility(model_file)"
+        )
+        
+        # Insert the patch right after the leading block of imports
+        content, count = _IMPORT_BLOCK_RE.subn(
+            lambda m: m.group(0) + _TF_COMPAT_PATCH, content, count=1
+        )
+        if count != 1:
+            print("Warning: Could not find imports to patch in utils.py")
+            return
+        
+        # Write back the patched content
+        with open(utils_file, 'w') as f:
+            f.write(content)
+        
+        print("Applied TensorFlow compatibility patch to Fawkes utils.py")
+        stamp.touch()
     
     def _patch_fawkes_for_m1_mac_compatibility(self):
         """Patch Fawkes differentiator to use legacy optimizer for M1/M2 Mac compatibility"""
+        stamp = self._patch_stamp("m1_mac_compatibility")
+        if stamp.exists():
+            return
+        
         diff_file = self.fawkes_dir / "fawkes" / "differentiator.py"
         if not diff_file.exists():
             return
@@ -201,6 +315,7 @@ original_load_extractor = None
         # Check if already patched
         if "tf.keras.optimizers.legacy.Adadelta" in content:
             print("M1/M2 Mac compatibility patch already applied")
+            stamp.touch()
             return
         
         # Replace the optimizer line
@@ -215,9 +330,14 @@ original_load_extractor = None
                 f.write(content)
             
             print("Applied M1/M2 Mac optimizer compatibility patch to Fawkes differentiator.py")
+            stamp.touch()
         else:
             print("Warning: Could not find optimizer line to patch in differentiator.py")
     
+    def _patch_stamp(self, name: str) -> Path:
+        """Marker file recording that the named patch has been applied"""
+        return self.fawkes_dir / f".patched_{name}"
+    
     def cloak_image(self, input_path: str, output_path: str, 
                    protection_level: str = "mid") -> bool:
         """
@@ -228,77 +348,236 @@ original_load_extractor = None
             output_path: Path to save cloaked image
             protection_level: low, mid, high
         """
-        if not self.setup_fawkes():
-            return False
+        return self.cloak_images([(input_path, output_path)], protection_level)[0]
+    
+    def cloak_images(self, pairs: List[Tuple[str, str]],
+                     protection_level: str = "mid") -> List[bool]:
+        """
+        Apply Fawkes cloaking to several images with a single Fawkes run
+        
+        Args:
+            pairs: (input_path, output_path) tuples
+            protection_level: low, mid, high
             
+        Returns:
+            Success flag for each pair
+        """
+        results = [False] * len(pairs)
+        if not pairs or not self.setup_fawkes():
+            return results
+        
+        # One temporary directory for the whole batch
+        temp_dir = Path(tempfile.mkdtemp())
         try:
-            # Create a temporary directory for processing
-            input_file = Path(input_path)
-            temp_dir = Path(tempfile.mkdtemp())
-            
-            # Copy input file to temp directory
-            temp_input = temp_dir / input_file.name
-            shutil.copy2(input_path, temp_input)
+            # Stage input files in temp directory; the index prefix keeps same-named files apart
+            temp_inputs = []
+            for i, (input_path, _) in enumerate(pairs):
+                temp_input = temp_dir / f"{i}_{Path(input_path).name}"
+                try:
+                    # Hardlink avoids copying bytes (Fawkes only reads its inputs)
+                    os.link(input_path, temp_input)
+                except OSError:
+                    # Different filesystem (EXDEV) or links unsupported
+                    shutil.copy2(input_path, temp_input)
+                temp_inputs.append(temp_input)
             
-            # Use the correct Fawkes script path
-            fawkes_script = self.fawkes_dir / "fawkes" / "protection.py"
-            
-            cmd = [
-                "python", str(fawkes_script),
-                "--directory", str(temp_dir),
-                "--gpu", "0" if self._has_gpu() else "-1",
-                "--mode", protection_level
-            ]
-            
-            # Set proper Python path to include Fawkes
-            env = os.environ.copy()
-            env['PYTHONPATH'] = str(self.fawkes_dir) + ':' + env.get('PYTHONPATH', '')
-            
-            print(f"Running Fawkes command: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True, text=True, env=env)
-            
-            print(f"Fawkes return code: {result.returncode}")
-            if result.stdout.strip():
-                print(f"Fawkes stdout: {result.stdout}")
-            if result.stderr.strip():
-                print(f"Fawkes stderr: {result.stderr}")
+            protector = self._get_protector(protection_level)
+            worker = self._get_worker(protection_level) if protector is None else None
+            if protector is not None:
+                # Reuse the already-loaded extractor/MTCNN models in this process
+                protector.run_protection([str(path) for path in temp_inputs], **_PROTECTION_ARGS)
+                succeeded = True
+            elif worker is not None:
+                succeeded = self._run_on_worker(protection_level, temp_inputs)
+            else:
+                succeeded = self._run_fawkes_subprocess(temp_dir, protection_level)
             
-            if result.returncode == 0:
-                # Find the cloaked output (Fawkes adds _cloaked suffix)
-                input_stem = input_file.stem
-                cloaked_patterns = [
-                    temp_dir / f"{input_stem}_cloaked.png",
-                    temp_dir / f"{input_stem}_cloaked.jpg",
-                    temp_dir / f"{input_stem}_cloaked{input_file.suffix}"
-                ]
-                
-                for cloaked_file in cloaked_patterns:
-                    if cloaked_file.exists():
-                        shutil.copy2(cloaked_file, output_path)
-                        # Cleanup temp directory
-                        shutil.rmtree(temp_dir)
-                        return True
+            if succeeded:
+                # One directory scan for the whole batch, keyed by file name without extension
+                created_files = {path.stem: path for path in temp_dir.iterdir()}
                 
-                # If no cloaked file found, list what was created
-                created_files = list(temp_dir.glob("*"))
-                print(f"Fawkes completed but no cloaked file found. Created: {created_files}")
+                for i, (temp_input, (input_path, output_path)) in enumerate(zip(temp_inputs, pairs)):
+                    # Find the cloaked output (Fawkes adds _cloaked suffix, whatever the extension)
+                    cloaked_file = created_files.get(f"{temp_input.stem}_cloaked")
+                    if cloaked_file is not None:
+                        # A rename when on the same filesystem, copy otherwise
+                        shutil.move(str(cloaked_file), output_path)
+                        results[i] = True
+                    else:
+                        print(f"Fawkes completed but no cloaked file found for {input_path}")
                 
-            else:
-                print(f"Fawkes error (return code {result.returncode}): {result.stderr}")
-                print(f"Fawkes stdout: {result.stdout}")
-                
-            # Cleanup temp directory
-            shutil.rmtree(temp_dir)
-            return False
-            
+                if not all(results):
+                    # List what was created to help debug missing outputs
+                    print(f"Files created by Fawkes: {list(created_files.values())}")
+                    
         except Exception as e:
             print(f"Error running Fawkes: {e}")
+        finally:
+            # Cleanup temp directory
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        
+        return results
+    
+    def _get_protector(self, protection_level: str):
+        """Return a cached in-process Fawkes protector for this mode, or None if it cannot be loaded"""
+        if self._in_process_unavailable:
+            return None
+        
+        if protection_level not in self._protectors:
+            try:
+                if str(self.fawkes_dir) not in sys.path:
+                    sys.path.insert(0, str(self.fawkes_dir))
+                from fawkes.protection import Fawkes
+                
+                print(f"Loading Fawkes ({protection_level} mode) in-process...")
+                gpu = "0" if self._has_gpu() else "-1"
+                # Fawkes only enables memory growth when it sets CUDA_VISIBLE_DEVICES itself;
+                # without it TensorFlow grabs nearly all VRAM up front
+                enable_tf_memory_growth()
+                # Fawkes' init_gpu rewrites CUDA_VISIBLE_DEVICES for the whole process; restore
+                # it so CUDA libraries initialised later (AdvCloak's torch) still see the GPU
+                visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+                try:
+                    self._protectors[protection_level] = Fawkes(
+                        "arcface_extractor_0", gpu, 1, mode=protection_level
+                    )
+                finally:
+                    if visible_devices is None:
+                        os.environ.pop("CUDA_VISIBLE_DEVICES", None)
+                    else:
+                        os.environ["CUDA_VISIBLE_DEVICES"] = visible_devices
+            except Exception as e:
+                print(f"Could not load Fawkes in-process ({e}), falling back to subprocess")
+                self._in_process_unavailable = True
+                return None
+        
+        return self._protectors[protection_level]
+    
+    @functools.cached_property
+    def _fawkes_env(self) -> dict:
+        """Environment for Fawkes subprocesses, with Fawkes on the Python path"""
+        python_path = [str(self.fawkes_dir)]
+        if os.environ.get('PYTHONPATH'):
+            python_path.append(os.environ['PYTHONPATH'])
+        return {**os.environ, 'PYTHONPATH': os.pathsep.join(python_path)}
+    
+    def _get_worker(self, protection_level: str) -> Optional[subprocess.Popen]:
+        """Return a running persistent Fawkes worker for this mode, starting it if needed"""
+        worker = self._workers.get(protection_level)
+        if worker is not None and worker.poll() is None:
+            return worker
+        if self._worker_unavailable:
+            return None
+        
+        cmd = [
+            sys.executable, self._worker_script,
+            "--mode", protection_level,
+            "--gpu", "0" if self._has_gpu() else "-1",
+            "--protection-args", json.dumps(_PROTECTION_ARGS)
+        ]
+        
+        print(f"Starting persistent Fawkes worker ({protection_level} mode)...")
+        # stderr is inherited so Fawkes progress stays visible and the pipe never fills up
+        worker = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                  text=True, bufsize=1, env=self._fawkes_env)
+        replies = queue.Queue()
+        threading.Thread(target=self._read_worker_replies, args=(worker, replies),
+                         daemon=True).start()
+        
+        reply = self._next_reply(replies, self.WORKER_START_TIMEOUT)
+        if reply != "READY":
+            self._stop_worker(worker)
+            print(f"Fawkes worker failed to start ({reply or 'no reply'}), "
+                  "falling back to one-shot subprocess")
+            self._worker_unavailable = True
+            return None
+        
+        self._workers[protection_level] = worker
+        self._worker_replies[protection_level] = replies
+        return worker
+    
+    @staticmethod
+    def _read_worker_replies(worker: subprocess.Popen, replies: queue.Queue):
+        """Forward a worker's stdout lines to a queue so reads can time out"""
+        for line in worker.stdout:
+            replies.put(line.strip())
+        # End of stream, the worker has exited
+        replies.put(None)
+    
+    @staticmethod
+    def _next_reply(replies: queue.Queue, timeout: float) -> Optional[str]:
+        """Wait for the next worker reply, None on timeout or when the worker exited"""
+        try:
+            return replies.get(timeout=timeout)
+        except queue.Empty:
+            return None
+    
+    def _run_on_worker(self, protection_level: str, image_paths: List[Path]) -> bool:
+        """Send one batch of images to a persistent worker and wait for it to finish"""
+        worker = self._workers[protection_level]
+        try:
+            worker.stdin.write(json.dumps([str(path) for path in image_paths]) + "\n")
+            worker.stdin.flush()
+        except OSError as e:
+            print(f"Fawkes worker error: {e}")
             return False
+        
+        timeout = self.WORKER_IMAGE_TIMEOUT * len(image_paths)
+        reply = self._next_reply(self._worker_replies[protection_level], timeout)
+        if reply == "DONE":
+            return True
+        
+        if reply is None:
+            # Hung or dead worker, stop it so the next batch starts a fresh one
+            print(f"Fawkes worker did not answer within {timeout}s, stopping it")
+            self._stop_worker(self._workers.pop(protection_level))
+            self._worker_replies.pop(protection_level)
+        else:
+            print(f"Fawkes worker error: {reply}")
+        return False
+    
+    @staticmethod
+    def _stop_worker(worker: subprocess.Popen):
+        """Kill a worker process and reap it"""
+        worker.kill()
+        worker.wait()
+    
+    def close(self):
+        """Stop any persistent Fawkes workers"""
+        for worker in self._workers.values():
+            if worker.poll() is None:
+                # Closing stdin ends the worker's read loop
+                worker.stdin.close()
+                try:
+                    worker.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self._stop_worker(worker)
+        self._workers.clear()
+        self._worker_replies.clear()
+    
+    def _run_fawkes_subprocess(self, temp_dir: Path, protection_level: str) -> bool:
+        """Run Fawkes' protection script on a directory in a separate interpreter"""
+        cmd = [
+            sys.executable, self._fawkes_script,
+            "--directory", str(temp_dir),
+            "--gpu", "0" if self._has_gpu() else "-1",
+            "--mode", protection_level
+        ]
+        
+        print(f"Running Fawkes command: {' '.join(cmd)}")
+        # Forward Fawkes output line by line instead of buffering the whole run
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              text=True, bufsize=1, env=self._fawkes_env) as proc:
+            for line in proc.stdout:
+                print(f"Fawkes: {line}", end='')
+            returncode = proc.wait()
+        
+        print(f"Fawkes return code: {returncode}")
+        if returncode != 0:
+            print(f"Fawkes error (return code {returncode}), see output above")
+            return False
+        return True
     
     def _has_gpu(self) -> bool:
         """Check if GPU is available"""
-        try:
-            import torch
-            return torch.cuda.is_available()
-        except:
-            return False 
\ No newline at end of file
+        return _detect_gpu()